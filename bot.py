@@ -1,9 +1,12 @@
 import asyncio
 import cairo
+import collections
 from datetime import datetime, timedelta, time, timezone
 import dotenv
 import discord
 import enum
+import functools
+import heapq
 from discord.ext import commands, tasks
 import io
 import json
@@ -11,24 +14,30 @@ import logging
 import logging.handlers
 import math
 import os
+import queue
 import random
 import re
+import threading
+from time import monotonic
 import typing
 
 dotenv.load_dotenv()
 
 ALPHABET = "абвгдеёжзийклмнопрстуфхцчшщъыьэюя"
-NOT_CYRILLIC_RE = re.compile(r"[^" + ALPHABET + "]")
+# Deletes every Cyrillic letter, so whatever is left of a word is not Cyrillic
+STRIP_CYRILLIC = str.maketrans("", "", ALPHABET)
+# Maps each letter to a character that sorts by its position in the alphabet (ё comes after е, not after я)
+ALPHABET_ORDER = str.maketrans({letter: chr(i + 1) for i, letter in enumerate(ALPHABET)})
 
 with open("twentythousandwords.txt") as file:
     common_words = file.read().splitlines()
-common_words.sort(key=lambda s: [ALPHABET.index(c) for c in s])
+common_words.sort(key=lambda s: s.translate(ALPHABET_ORDER))
 
 with open("wiktionary_ru.txt") as file:
     all_words = file.read().splitlines()
 all_words += common_words
 all_words = list(dict.fromkeys(all_words))
-all_words.sort(key=lambda s: [ALPHABET.index(c) for c in s])
+all_words.sort(key=lambda s: s.translate(ALPHABET_ORDER))
 print(f"Loaded {len(all_words)} words")
 
 with open("soft_masculine_nouns.txt") as file:
@@ -42,14 +51,16 @@ print(f"Loaded {len(feminine_nouns)} soft feminine nouns")
 soft_nouns = list(set(masculine_nouns + feminine_nouns).intersection(common_words))
 
 with open("removed_words.txt") as file:
-    removed_words = file.read().splitlines()
-for removed_word in removed_words:
-    try:
-        common_words.remove(removed_word)
-    except ValueError:
-        pass
+    removed_words = set(file.read().splitlines())
+common_words = [word for word in common_words if word not in removed_words]
 
-common_words_by_length = [[word for word in common_words if len(word) == i] for i in range(24)]
+all_words_set = frozenset(all_words)
+common_words_set = set(common_words)
+
+common_words_by_length = [[] for _ in range(24)]
+for word in common_words:
+    if len(word) < len(common_words_by_length):
+        common_words_by_length[len(word)].append(word)
 
 @enum.unique
 class GameState(enum.IntEnum):
@@ -57,19 +68,40 @@ class GameState(enum.IntEnum):
     FINISHED = 1
     RESTARTING = 2
 
+def compact_json(obj):
+    # Words are stored as plain UTF-8, rather than six-byte \u escapes for every letter
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+def game_state(game):
+    # Attributes starting with an underscore can be derived from the others, and aren't saved
+    return {key: value for key, value in game.__dict__.items() if not key.startswith("_")}
+
+# Number of journal entries after which a full snapshot is written instead
+JOURNAL_LIMIT = 100
+
 class GameManager():
     def __init__(self, game_type):
         self.channels = []
         self.game_type = game_type
         self.games = {}
+        self.journal_lengths = {}
+        # Every snapshot gets a new generation, and journal entries are tagged with the generation they apply to
+        self.generations = {}
+        # Writes for a channel are serialized, so they hit the disk in the order they were made
+        self.locks = collections.defaultdict(asyncio.Lock)
 
     def add_channel(self, channel_id : int):
         self.channels.append(channel_id)
         try:
-            with open(f"{channel_id}.json") as f:
+            with open(f"{channel_id}.json", encoding="utf-8") as f:
                 try:
                     resume = json.load(f)
+                    self.replay_journal(channel_id, resume)
                     self.games[channel_id] = self.game_type(resume)
+                    # Save the game as it is now, in the current format and with the journal folded in.
+                    # Later journal entries then always refer to the format of the snapshot they apply to
+                    self.write_snapshot(channel_id, self.snapshot_data(channel_id, self.games[channel_id]))
+                    self.journal_lengths[channel_id] = 0
                 except ValueError:
                     logging.getLogger('discord').error(f"Malformed JSON file: {channel_id}.json")
                     os.remove(f"{channel_id}.json")
@@ -84,14 +116,15 @@ class GameManager():
         except (KeyError, ValueError):
             pass
 
-        try:
-            os.remove(f"{channel_id}.json")
-        except Exception:
-            pass
+        for filename in (f"{channel_id}.json", f"{channel_id}.log"):
+            try:
+                os.remove(filename)
+            except Exception:
+                pass
 
-    def add_game(self, channel_id : int, game):
+    async def add_game(self, channel_id : int, game):
         self.games[channel_id] = game
-        self.update_game(channel_id, game)
+        await self.update_game(channel_id, game)
 
     def get_game(self, channel_id : int):
         try:
@@ -99,9 +132,67 @@ class GameManager():
         except KeyError:
             return None
 
-    def update_game(self, channel_id, game):
-        with open(f"{channel_id}.json", "w") as f:
-            json.dump(game.__dict__, f)
+    async def update_game(self, channel_id, game):
+        # Serialize right away, so the game can't change while the file is being written
+        data = self.snapshot_data(channel_id, game)
+        # The snapshot includes every journaled change
+        self.journal_lengths[channel_id] = 0
+        async with self.locks[channel_id]:
+            await asyncio.to_thread(self.write_snapshot, channel_id, data)
+
+    async def journal_update(self, channel_id, key, value):
+        """Record a single change to a game without rewriting its snapshot"""
+        # The key is either an attribute name, or a path of keys into the game's dict
+        if self.journal_lengths.get(channel_id, 0) >= JOURNAL_LIMIT:
+            await self.update_game(channel_id, self.games[channel_id])
+            return
+
+        line = compact_json([self.generations.get(channel_id, 0), key, value]) + "\n"
+        self.journal_lengths[channel_id] = self.journal_lengths.get(channel_id, 0) + 1
+        async with self.locks[channel_id]:
+            await asyncio.to_thread(self.append_journal, channel_id, line)
+
+    def snapshot_data(self, channel_id, game):
+        self.generations[channel_id] = self.generations.get(channel_id, 0) + 1
+        return compact_json({**game_state(game), "journal_generation": self.generations[channel_id]})
+
+    def write_snapshot(self, channel_id, data):
+        with open(f"{channel_id}.json", "w", encoding="utf-8") as f:
+            f.write(data)
+
+        try:
+            os.remove(f"{channel_id}.log")
+        except FileNotFoundError:
+            pass
+
+    def append_journal(self, channel_id, line):
+        with open(f"{channel_id}.log", "a", encoding="utf-8") as f:
+            f.write(line)
+
+    def replay_journal(self, channel_id, resume):
+        self.journal_lengths[channel_id] = 0
+        self.generations[channel_id] = resume.pop("journal_generation", 0)
+        try:
+            with open(f"{channel_id}.log", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        generation, key, value = json.loads(line)
+                        # A crash right after writing a snapshot can leave the journal of the one before it
+                        if generation != self.generations[channel_id]:
+                            continue
+                        target = resume
+                        if isinstance(key, list):
+                            *path, key = key
+                            for step in path:
+                                target = target[step]
+                        target[key] = value
+                    except (ValueError, KeyError, IndexError, TypeError):
+                        # A crash can leave a partially written entry at the end
+                        logging.getLogger('discord').error(f"Malformed journal entry in {channel_id}.log: {line!r}")
+                        break
+                    self.journal_lengths[channel_id] += 1
+        except FileNotFoundError:
+            pass
 
 COLOR_ABSENT  = (0x78/0xff, 0x7c/0xff, 0x7e/0xff)
 COLOR_PRESENT = (0xc9/0xff, 0xb4/0xff, 0x58/0xff)
@@ -118,40 +209,64 @@ def rounded_rect(context, x, y, w, h, r):
 
     context.close_path()
 
-def draw_word(word, colors):
-
+# A surface and its context are set up once for every image width, and reused from then on.
+# Cairo contexts can't be used by two renders at the same time
+surface_pool = {}
+surface_pool_lock = threading.Lock()
+
+def pooled_surface(length):
+    if length not in surface_pool:
+        surface = cairo.ImageSurface(cairo.Format.ARGB32, 10 + length * (80+10), 100)
+        cr = cairo.Context(surface)
+        cr.select_font_face("Sans")
+        options = cr.get_font_options()
+        options.set_antialias(cairo.Antialias.GRAY)
+        cr.set_font_options(options)
+        cr.set_font_size(60)
+        surface_pool[length] = (surface, cr)
+
+    return surface_pool[length]
+
+# Identical guesses are common, so keep the encoded images around
+@functools.lru_cache(maxsize=512)
+def render_word(word, colors):
     length = 8 if len(word) <= 8 else len(word)
-    surface = cairo.ImageSurface(cairo.Format.ARGB32, 10 + length * (80+10), 100)
-    cr = cairo.Context(surface)
-    cr.select_font_face("Sans")
-    options = cr.get_font_options()
-    options.set_antialias(cairo.Antialias.GRAY)
-    cr.set_font_options(options)
-    cr.set_font_size(60)
-    cr.set_source_rgba(1, 1, 1, 0)
-    cr.paint()
-
-    for i, letter in enumerate(word):
-        rounded_rect(cr, 10 + i * (80+10), 10, 80, 80, 5)
+    with surface_pool_lock:
+        surface, cr = pooled_surface(length)
+        cr.save()
+        cr.set_operator(cairo.Operator.CLEAR)
+        cr.paint()
+        cr.set_operator(cairo.Operator.OVER)
+
+        draw_tiles(cr, word, colors)
+
+        file_obj = io.BytesIO()
+        surface.write_to_png(file_obj)
+        cr.restore()
+
+    return file_obj.getvalue()
+
+def draw_tiles(cr, word, colors):
+    cr.set_line_width(2)
+    for i, letter in enumerate(word.lower()):
+        x = 10 + i * (80+10)
+        rounded_rect(cr, x, 10, 80, 80, 5)
 
         cr.set_source_rgb(colors[i][0], colors[i][1], colors[i][2])
         cr.fill_preserve()
 
-        cr.set_line_width(2)
         cr.set_source_rgb(0, 0, 0)
         cr.stroke()
 
         cr.set_source_rgb(1, 1, 1)
-        extents = cr.text_extents(letter.lower())
+        extents = cr.text_extents(letter)
 
-        cr.move_to(10 + i*(80+10)+40- extents.x_bearing - extents.width / 2,10+40 - (extents.y_bearing*0) + extents.height*0/2 + 16)
-        cr.show_text(letter.lower())
+        # Centered horizontally, with the baseline at a fixed height
+        cr.move_to(x + 40 - extents.x_bearing - extents.width / 2, 10+40 + 16)
+        cr.show_text(letter)
 
-    file_obj = io.BytesIO()
-    surface.write_to_png(file_obj)
-    file_obj.seek(0)
-
-    return file_obj
+def draw_word(word, colors):
+    return io.BytesIO(render_word(word, tuple(colors)))
 
 class WordleGame:
     def __init__(self, resume=None):
@@ -176,19 +291,19 @@ class WordleGame:
         if len(guess) != len(self.solution):
             return "🔢", None, None
 
-        if guess not in all_words:
+        if guess not in all_words_set:
             return "❓", None, None
 
         colors = [COLOR_ABSENT] * len(self.solution)
 
-        tally = {letter:self.solution.count(letter) for letter in self.solution}
+        tally = collections.Counter(self.solution)
         for i, letter in enumerate(guess):
             if letter == self.solution[i]:
                 colors[i] = COLOR_CORRECT
                 tally[letter] -= 1
 
         for i, letter in enumerate(guess):
-            if letter in tally and tally[letter] > 0 and letter != self.solution[i]:
+            if tally[letter] > 0 and letter != self.solution[i]:
                 colors[i] = COLOR_PRESENT
                 tally[letter] -= 1
 
@@ -230,7 +345,7 @@ class Wordle(commands.Cog):
                 await self.start_game(channel)
 
     def guild_setup(self, guild):
-        channel = discord.utils.get(guild.channels, name=self.CHANNEL_NAME)
+        channel = next((channel for channel in guild.text_channels if channel.name == self.CHANNEL_NAME), None)
         if not channel:
             return None
         self.logger.info(f"Found #{self.CHANNEL_NAME} channel in {guild}: {channel.id}")
@@ -257,7 +372,6 @@ class Wordle(commands.Cog):
             return
 
         game.state = GameState.FINISHED
-        self.game_manager.update_game(ctx.channel.id, game)
         await ctx.send(f"Oops! The word was **{game.solution}**. Was it too hard?")
         await self.stop_game(ctx.channel.id)
 
@@ -279,7 +393,8 @@ class Wordle(commands.Cog):
             return
 
         game.state = GameState.RESTARTING
-        self.game_manager.update_game(channel_id, game)
+        # Only the state is saved, the next game's snapshot replaces the rest
+        await self.game_manager.journal_update(channel_id, "state", game.state)
 
         async with self.bot.get_channel(channel_id).typing():
             await asyncio.sleep(3)
@@ -292,9 +407,7 @@ class Wordle(commands.Cog):
             return
         if message.author == self.bot.user:
             return
-        ctx = await self.bot.get_context(message)
-        if ctx.command:
-            return
+        # No need to check for commands: the prefix already fails the check for Cyrillic below
 
         game = self.game_manager.get_game(message.channel.id)
         if not game or game.state != GameState.CONTINUE:
@@ -304,7 +417,7 @@ class Wordle(commands.Cog):
             return
         guess = message.content.strip().lower()
 
-        if not guess or NOT_CYRILLIC_RE.search(guess):
+        if not guess or guess.translate(STRIP_CYRILLIC):
             return
 
         self.logger.info(f"{message.author.display_name} trying {guess}")
@@ -318,19 +431,21 @@ class Wordle(commands.Cog):
         elif msg:
             await message.channel.send(msg, suppress_embeds=True)
 
-        self.game_manager.update_game(message.channel.id, game)
-
+        # A finished game only has its state saved, by stop_game
         if game.state == GameState.FINISHED:
             await self.stop_game(message.channel.id)
+        elif file_obj:
+            await self.game_manager.journal_update(message.channel.id, "guesses", game.guesses)
 
     async def start_game(self, channel_id):
         if channel_id not in self.game_manager.channels:
             return
 
+        channel = self.bot.get_channel(channel_id)
         game = WordleGame()
-        self.logger.info(f"Starting new game in {self.bot.get_channel(channel_id).guild}: {game.solution}")
-        self.game_manager.add_game(channel_id, game)
-        await self.bot.get_channel(channel_id).send(f"I picked a word of {len(game.solution)} letters. Good luck!\n\n⬜ Grey square: The letter is not in the word\n🟨 Yellow square: The letter is in the word, but not in that place\n🟩 Green square: The letter is in the word, and it is in the correct place!")
+        self.logger.info(f"Starting new game in {channel.guild}: {game.solution}")
+        await self.game_manager.add_game(channel_id, game)
+        await channel.send(f"I picked a word of {len(game.solution)} letters. Good luck!\n\n⬜ Grey square: The letter is not in the word\n🟨 Yellow square: The letter is in the word, but not in that place\n🟩 Green square: The letter is in the word, and it is in the correct place!")
 
 class PersistentGenderView(discord.ui.View):
     def __init__(self, cog):
@@ -382,7 +497,7 @@ class SoftSign(commands.Cog):
             self.guild_setup(guild)
 
     def guild_setup(self, guild):
-        channel = discord.utils.get(guild.channels, name=self.CHANNEL_NAME)
+        channel = next((channel for channel in guild.text_channels if channel.name == self.CHANNEL_NAME), None)
         if not channel:
             return
         self.logger.info(f"Found #{self.CHANNEL_NAME} channel in {guild}: {channel.id}")
@@ -427,56 +542,93 @@ class SoftSign(commands.Cog):
 MIN_LENGTH = 3
 MAX_LENGTH = 7
 
+# Trie of every word a spelling game can use. Each node maps a letter to the next node,
+# and has the key "$" if the letters leading up to it form a word
+spelling_trie = {}
+for word in all_words:
+    if MIN_LENGTH <= len(word) <= MAX_LENGTH:
+        node = spelling_trie
+        for letter in word:
+            node = node.setdefault(letter, {})
+        node["$"] = True
+
+def sub_anagrams(node, remaining, prefix=""):
+    """Yield every word in the trie that can be spelled with the remaining letters, in alphabetical order"""
+    if "$" in node:
+        yield prefix
+
+    for letter, child in node.items():
+        if letter == "$" or remaining[letter] == 0:
+            continue
+        remaining[letter] -= 1
+        yield from sub_anagrams(child, remaining, prefix + letter)
+        remaining[letter] += 1
+
 class SpellingGame():
     def __init__(self, resume=None):
         if resume:
             self.__dict__ = resume
-            return
+            if "words" in resume:
+                # Games saved before words and their finders were stored as separate lists
+                words = self.__dict__.pop("words")
+                other_words = self.__dict__.pop("other_words")
+                self.word_list, self.word_finder = list(words.keys()), list(words.values())
+                self.other_word_list, self.other_word_finder = list(other_words.keys()), list(other_words.values())
+        else:
+            self.new_game()
+
+        self._word_index = {word: i for i, word in enumerate(self.word_list)}
+        self._other_word_index = {word: i for i, word in enumerate(self.other_word_list)}
 
+    def new_game(self):
         self.state = GameState.CONTINUE
         self.deadline = int((datetime.now().replace(microsecond=0,second=0,minute=0) + timedelta(hours=24)).timestamp())
 
         self.root_word = random.choice(common_words_by_length[10])
-        letters = list(self.root_word)
 
         solution_words = []
         acceptable_words = []
-        for word in all_words:
-            if not MIN_LENGTH <= len(word) <= MAX_LENGTH:
-                continue
-
-            if all(letter in letters for letter in word):
-                if any(letters.count(letter) < list(word).count(letter) for letter in letters):
-                    continue
-                if word in common_words:
-                    solution_words.append(word)
-                else:
-                    acceptable_words.append(word)
+        for word in sub_anagrams(spelling_trie, collections.Counter(self.root_word)):
+            if word in common_words_set:
+                solution_words.append(word)
+            else:
+                acceptable_words.append(word)
 
-        self.words = dict.fromkeys(solution_words)
-        self.other_words = dict.fromkeys(acceptable_words)
+        # The user id of whoever found each word, or None
+        self.word_list = solution_words
+        self.word_finder = [None] * len(solution_words)
+        self.other_word_list = acceptable_words
+        self.other_word_finder = [None] * len(acceptable_words)
 
     def guess(self, guess, author):
 
-        if guess in self.words:
-            if self.words[guess] is not None:
+        if guess in self._word_index:
+            i = self._word_index[guess]
+            if self.word_finder[i] is not None:
                 return "🔁"
             else:
-                self.words[guess] = author.id
-                if all(self.words.values()):
+                self.word_finder[i] = author.id
+                if all(self.word_finder):
                     self.state = GameState.FINISHED
                 return "✅"
-        elif guess in self.other_words:
-            if self.other_words[guess] is not None:
+        elif guess in self._other_word_index:
+            i = self._other_word_index[guess]
+            if self.other_word_finder[i] is not None:
                 return "🔁"
             else:
-                self.other_words[guess] = author.id
+                self.other_word_finder[i] = author.id
                 return "📚"
-        elif guess in all_words:
+        elif guess in all_words_set:
             return "❎"
 
         return "❓"
 
+    def finder_key(self, word):
+        """Where the finder of a word is stored, as a path into the game's dict"""
+        if word in self._word_index:
+            return ("word_finder", self._word_index[word])
+        return ("other_word_finder", self._other_word_index[word])
+
     def winners_and_losers(self, guild):
         NATIVE_NAMES = ["Сладкая Пилюля", "ЯЖПОГРОМИСТ", "Fish-Teacher", "Trogdor the destroyer", "He🇧🇧🇧🇧🇧🇧🇧", "Ксения"]
         LEARNER_NAMES = ["Kwinten", "Liisa", "Leeto", "Zalamلظلام", "ХАРА́М"]
@@ -486,9 +638,9 @@ class SpellingGame():
         natives_score = 0
         natives = set()
 
-        words = self.words | self.other_words
+        native_role = discord.utils.get(guild.roles, name="Native")
 
-        for user_id in words.values():
+        for user_id in self.word_finder + self.other_word_finder:
             if not user_id:
                 continue
 
@@ -505,7 +657,7 @@ class SpellingGame():
             if not member:
                 continue
 
-            if any(role.name == "Native" for role in member.roles):
+            if native_role and member.get_role(native_role.id):
                 natives.add(member.display_name)
                 natives_score += 1
             else:
@@ -527,15 +679,17 @@ class SpellingGame():
     def progress_embed(self):
         game_ended = self.state != GameState.CONTINUE
         COLUMNS_BY_LENGTH = [0, 0, 0, 4, 3, 3, 2, 2, 2]
-        solutions_by_length = [[word for word in self.words if len(word) == i] for i in range(MAX_LENGTH + 1)]
+        solutions_by_length = [[] for _ in range(MAX_LENGTH + 1)]
+        for word, user_id in zip(self.word_list, self.word_finder):
+            solutions_by_length[len(word)].append((word, user_id))
         line = ""
         lines = []
         for length in range(MIN_LENGTH, MAX_LENGTH + 1):
             if not solutions_by_length[length]:
                 continue
 
-            for count, word in enumerate(solutions_by_length[length]):
-                if self.words[word]:
+            for count, (word, user_id) in enumerate(solutions_by_length[length]):
+                if user_id:
                     if game_ended:
                         line += "~~" + word + "~~"
                     else:
@@ -562,8 +716,8 @@ class SpellingGame():
         msgl = '\n'.join(lines[:len(lines)//2])
         msgr = '\n'.join(lines[len(lines)//2:])
 
-        found_words = sum(1 for word, user_id in self.words.items() if user_id)
-        total_words = len(self.words)
+        found_words = sum(1 for user_id in self.word_finder if user_id)
+        total_words = len(self.word_list)
         embed = discord.Embed(title=f"Progress: {found_words} out of {total_words} found", description="The game has ended" if game_ended else f"The game ends <t:{self.deadline}:R>")
         embed.add_field(name="\u200b", value=msgl, inline=True)
         embed.add_field(name="\u200b", value=msgr, inline=True)
@@ -596,7 +750,7 @@ class Spelling(commands.Cog):
                 await self.start_game(channel)
 
     def guild_setup(self, guild):
-        channel = discord.utils.get(guild.channels, name=self.CHANNEL_NAME)
+        channel = next((channel for channel in guild.text_channels if channel.name == self.CHANNEL_NAME), None)
         if not channel:
             return None
         self.logger.info(f"Found #{self.CHANNEL_NAME} channel in {guild}: {channel.id}")
@@ -635,11 +789,11 @@ class Spelling(commands.Cog):
         if not game:
             return
 
-        for word in game.words:
+        for i in range(len(game.word_finder)):
             if random.random() < 0.5:
-                game.words[word] = 1 + random.randrange(5) + random.choice([0,100])
+                game.word_finder[i] = 1 + random.randrange(5) + random.choice([0,100])
 
-        self.game_manager.update_game(ctx.channel.id, game)
+        await self.game_manager.update_game(ctx.channel.id, game)
 
     @commands.command()
     async def progress(self, ctx):
@@ -705,7 +859,7 @@ class Spelling(commands.Cog):
         """The outcome of the previous game"""
         channel_id = ctx.channel.id
         try:
-            with open(f"{channel_id}-previousgame.json") as f:
+            with open(f"{channel_id}-previousgame.json", encoding="utf-8") as f:
                 winnersdict, losersdict, timestamp, gamedict = json.load(f)
             winners = Team(**winnersdict)
             losers = Team(**losersdict)
@@ -755,9 +909,7 @@ class Spelling(commands.Cog):
             return
         if message.author == self.bot.user:
             return
-        ctx = await self.bot.get_context(message)
-        if ctx.command:
-            return
+        # No need to check for commands: the prefix already fails the check for Cyrillic below
 
         game = self.game_manager.get_game(message.channel.id)
         if not game or game.state != GameState.CONTINUE:
@@ -768,7 +920,7 @@ class Spelling(commands.Cog):
 
         guess = message.content.strip().lower()
 
-        if NOT_CYRILLIC_RE.search(guess):
+        if guess.translate(STRIP_CYRILLIC):
             return
 
         self.logger.info(f"{message.author.display_name} guesses {guess}")
@@ -777,10 +929,11 @@ class Spelling(commands.Cog):
         if emoji:
             await message.add_reaction(emoji)
 
-        self.game_manager.update_game(message.channel.id, game)
-
+        # A finished game only has its state saved, by stop_game
         if game.state == GameState.FINISHED:
             await self.stop_game(message.channel.id)
+        elif emoji in ("✅", "📚"):
+            await self.game_manager.journal_update(message.channel.id, game.finder_key(guess), message.author.id)
 
     async def stop_game(self, channel_id):
         game = self.game_manager.get_game(channel_id)
@@ -791,16 +944,18 @@ class Spelling(commands.Cog):
             return
 
         game.state = GameState.RESTARTING
-        self.game_manager.update_game(channel_id, game)
+        # Only the state is saved, the next game's snapshot replaces the rest
+        await self.game_manager.journal_update(channel_id, "state", game.state)
 
-        guild = self.bot.get_channel(channel_id).guild
+        channel = self.bot.get_channel(channel_id)
+        guild = channel.guild
 
         msg = "Alright, the game is over! "
         embed = None
         winners, losers = game.winners_and_losers(guild)
         if winners and losers:
-            with open(f"{channel_id}-previousgame.json", "w") as f:
-                json.dump((winners._asdict(), losers._asdict(), int(datetime.now().timestamp()), game.__dict__), f)
+            with open(f"{channel_id}-previousgame.json", "w", encoding="utf-8") as f:
+                f.write(compact_json((winners._asdict(), losers._asdict(), int(datetime.now().timestamp()), game_state(game))))
 
             teams_msg = self.teams_message(winners, losers, game_ended=True)
             msg += random.choice(["Good job!", "Congratulations everyone!", "Excellent work!"]) + " "
@@ -809,9 +964,9 @@ class Spelling(commands.Cog):
 
             embed = game.progress_embed()
 
-        await self.bot.get_channel(channel_id).send(msg, embed=embed)
+        await channel.send(msg, embed=embed)
 
-        async with self.bot.get_channel(channel_id).typing():
+        async with channel.typing():
             await asyncio.sleep(3)
 
         await self.start_game(channel_id)
@@ -820,15 +975,16 @@ class Spelling(commands.Cog):
         if channel_id not in self.game_manager.channels:
             return
 
+        channel = self.bot.get_channel(channel_id)
         game = SpellingGame()
-        self.game_manager.add_game(channel_id, game)
-        self.logger.info(f"Starting new spelling game in {self.bot.get_channel(channel_id).guild} with word {game.root_word}")
+        await self.game_manager.add_game(channel_id, game)
+        self.logger.info(f"Starting new spelling game in {channel.guild} with word {game.root_word}")
 
         msg = "Let's play a game! I will give you a word and you have to **make smaller words (3-7 letters long) out of it using each letter at most once.**\n"
-        msg += f"The game will go on until all these words have been found, or until <t:{game.deadline}:t> (this time is automatically adjusted to your timezone). There are **{len(game.words)}** words to be found.\n\n"
+        msg += f"The game will go on until all these words have been found, or until <t:{game.deadline}:t> (this time is automatically adjusted to your timezone). There are **{len(game.word_list)}** words to be found.\n\n"
         msg += f"Your word is **{game.root_word}**"
 
-        await self.bot.get_channel(channel_id).send(msg)
+        await channel.send(msg)
 
     @tasks.loop(time=CHECK_DEADLINE_TIMES)
     async def check_deadline(self):
@@ -850,27 +1006,59 @@ class Spelling(commands.Cog):
         await self.bot.wait_until_ready()
         await self.check_deadline()
 
+# Server Monitoring's reply to a bump that came too early, followed by the countdown
+NEXT_BUMP_MARKER = "The next Bump for this server will be available in"
+# Hours, minutes and seconds until the next bump, as reported by Server Monitoring
+BUMP_DELTA_RE = re.compile(r"(\d+):(\d+):(\d+)")
+BUMP_REACTIONS = ("🙏", "🤗", "😻", "😌", "❤")
+
+MEOWS = ("meow", "мяу", "miauw", "مياو")
+
+# The contents of the selfies directory are rescanned at most once every this many seconds
+SELFIES_TTL = 60
+selfies = []
+selfies_scanned = None
+
+def list_selfies():
+    global selfies, selfies_scanned
+    if selfies_scanned is None or monotonic() - selfies_scanned > SELFIES_TTL:
+        selfies = os.listdir("selfies")
+        selfies_scanned = monotonic()
+    return selfies
+
+@functools.lru_cache(maxsize=16)
+def read_selfie(filename):
+    with open(os.path.join("selfies", filename), "rb") as f:
+        return f.read()
 
 class BumpReminder(commands.Cog):
     CHANNEL_NAME = "bumps"
     def __init__(self, bot):
         self.bot = bot
         self.logger = logging.getLogger('discord').getChild(self.__class__.__name__)
-        self.channels = []
-        self.reminders_disboard = {}
-        self.reminders_server_monitoring = {}
+        self.channels = {}
+        # The latest reminder for every (channel_id, bot name)
+        self.reminders = {}
+        # Heap of (due, channel_id, bot name, reminder), where due is the reminder in event loop time.
+        # An entry is stale if that reminder has since been pushed back, and is then skipped
+        self.reminder_queue = []
+        self.reminder_added = asyncio.Event()
 
         for guild in self.bot.guilds:
             self.guild_setup(guild)
 
-        self.check_reminders.start()
+        self.start_reminders()
+
+    async def cog_unload(self):
+        self.reminder_task.cancel()
+        self.replay_task.cancel()
 
     def guild_setup(self, guild):
-        channel = discord.utils.get(guild.channels, name=self.CHANNEL_NAME)
+        channel = next((channel for channel in guild.text_channels if channel.name == self.CHANNEL_NAME), None)
         if not channel:
             return None
         self.logger.info(f"Found #{self.CHANNEL_NAME} channel in {guild}: {channel.id}")
-        self.channels.append(channel.id)
+        self.channels[channel.id] = channel
         return channel.id
 
     @commands.Cog.listener()
@@ -882,84 +1070,149 @@ class BumpReminder(commands.Cog):
     @commands.Cog.listener()
     async def on_guild_remove(self, guild):
         for channel in guild.channels:
-            if channel.id in self.channels:
-                self.channels.remove(channel.id)
+            self.channels.pop(channel.id, None)
 
     @commands.Cog.listener()
     async def on_message(self, message):
+        # Direct messages are handled here as well, so every message only passes through one listener
+        if isinstance(message.channel, discord.DMChannel):
+            if message.author.id != self.bot.user.id:
+                await self.reply_to_dm(message)
+            return
+        # Bumps are confirmed by other bots, so all human chatter can be skipped right away
+        if not message.author.bot:
+            return
         if message.channel.id not in self.channels:
             return
-        if message.author == bot.user:
+        if message.author.id == self.bot.user.id:
             return
         if self.update_bump_time(message):
-            await message.add_reaction(random.choice(["🙏", "🤗", "😻", "😌", "❤"]))
+            await message.add_reaction(random.choice(BUMP_REACTIONS))
+
+    async def reply_to_dm(self, msg):
+        await msg.channel.send(random.choice(MEOWS))
+
+        if random.random() < 0.05:
+            self.logger.info(f"{msg.author.display_name} is getting a selfie")
+
+            try:
+                filename = random.choice(list_selfies())
+                data = read_selfie(filename)
+                async with msg.channel.typing():
+                    await msg.channel.send(file=discord.File(io.BytesIO(data), filename=filename))
+            except OSError:
+                pass
 
     async def cog_load(self):
-        for channel in self.channels:
-            async for msg in self.bot.get_channel(channel).history(limit=150):
+        # Reading back the bump channels takes a request each, and the bot doesn't have to wait for that
+        self.replay_task = asyncio.create_task(self.replay_histories())
+
+    async def replay_histories(self):
+        await asyncio.gather(*(self.replay_history(channel) for channel in self.channels.values()))
+
+    async def replay_history(self, channel):
+        try:
+            async for msg in channel.history(limit=150):
                 self.update_bump_time(msg)
+        except Exception as e:
+            self.logger.error(f"Could not read the history of {channel.id}: " + str(e))
+
+    def disboard_delta(self, description):
+        if "Bump done!" not in description:
+            return None
+        return timedelta(hours=2)
+
+    def server_monitoring_delta(self, description):
+        # A successful bump takes precedence, wherever it is mentioned
+        if "Server bumped by" in description:
+            return timedelta(hours=4)
+        start = description.find(NEXT_BUMP_MARKER)
+        if start == -1:
+            return None
+
+        try:
+            delta_match = BUMP_DELTA_RE.search(description, start + len(NEXT_BUMP_MARKER))
+            return timedelta(hours=int(delta_match[1]), minutes=int(delta_match[2]), seconds=int(delta_match[3]) + 1) # XXX
+        except Exception as e: # XXX
+            self.logger.error(f"Could not parse message as timedelta! " + str(e))
+            return None
+
+    # How long until the next bump, for each bump bot, given the description of its message
+    BUMP_DELTAS = {
+        "DISBOARD": disboard_delta,
+        "Server Monitoring": server_monitoring_delta,
+    }
+    REMINDER_MESSAGES = {
+        "DISBOARD": "Time to bump Disboard!",
+        "Server Monitoring": "Time to bump Server Monitoring!",
+    }
 
     def update_bump_time(self, msg):
         channel_id = msg.channel.id
-        if msg.author.name == "DISBOARD":
-            if not msg.embeds or "Bump done!" not in msg.embeds[0].description:
-                return False
-            delta = timedelta(hours=2)
-            reminders = self.reminders_disboard
-        elif msg.author.name == "Server Monitoring":
-            if not msg.embeds:
-                return False
-
-            if "Server bumped by" in msg.embeds[0].description:
-                delta = timedelta(hours=4)
-            elif "The next Bump for this server will be available in" in msg.embeds[0].description:
-                try:
-                    delta_regex = re.compile('(?P<hours>\d+):(?P<minutes>\d+):(?P<seconds>\d+)')
-                    delta_match = delta_regex.search(msg.embeds[0].description)
-                    delta = timedelta(hours=int(delta_match['hours']), minutes=int(delta_match['minutes']), seconds=int(delta_match['seconds']) + 1) # XXX
-                except Exception as e: # XXX
-                    self.logger.error(f"Could not parse message as timedelta! " + str(e))
-                    return False
-            else:
-                return False
+        bump_delta = self.BUMP_DELTAS.get(msg.author.name)
+        if not bump_delta or not msg.embeds:
+            return False
 
-            reminders = self.reminders_server_monitoring
-        else:
+        delta = bump_delta(self, msg.embeds[0].description or "")
+        if not delta:
             return False
 
+        key = (channel_id, msg.author.name)
         reminder = msg.created_at + delta
-        if channel_id in reminders and reminder <= reminders[channel_id]:
+        if key in self.reminders and reminder <= self.reminders[key]:
             return False
-        if reminder < datetime.now(timezone.utc):
+        remaining = (reminder - datetime.now(timezone.utc)).total_seconds()
+        if remaining < 0:
             # if a reminder is scheduled for the past, we either already made it, or we've been out so
             # so long there's no telling what's going on
             return False
 
-        reminders[channel_id] = reminder
+        self.reminders[key] = reminder
+        due = asyncio.get_running_loop().time() + remaining
+        heapq.heappush(self.reminder_queue, (due, channel_id, msg.author.name, reminder))
+        self.reminder_added.set()
         self.logger.info(f"Successful {msg.author.name} bump. Reminding in " + str(delta) + ", which is at " + str(reminder))
 
         return True
 
-    @tasks.loop(minutes=5)
-    async def check_reminders(self):
-        now = datetime.now(timezone.utc)
-
-        for channel_id in self.channels:
-            if self.reminders_disboard.get(channel_id, now) < now:
-                msg = "Time to bump Disboard!"
-                self.reminders_disboard.pop(channel_id)
-            elif self.reminders_server_monitoring.get(channel_id, now) < now:
-                msg = "Time to bump Server Monitoring!"
-                self.reminders_server_monitoring.pop(channel_id)
-            else:
-                continue
+    def start_reminders(self):
+        self.reminder_task = asyncio.create_task(self.send_reminders())
+        self.reminder_task.add_done_callback(self.reminders_stopped)
 
-            await self.bot.get_channel(channel_id).send(msg)
+    def reminders_stopped(self, task):
+        if task.cancelled():
+            return
+        # The task only ever ends on an error, and no reminders would be sent anymore
+        self.logger.error("Reminder task stopped unexpectedly, restarting it", exc_info=task.exception())
+        self.start_reminders()
 
-    @check_reminders.before_loop
-    async def before_check_reminders(self):
+    async def send_reminders(self):
         await self.bot.wait_until_ready()
 
+        while True:
+            self.reminder_added.clear()
+            if not self.reminder_queue:
+                await self.reminder_added.wait()
+                continue
+
+            delay = self.reminder_queue[0][0] - asyncio.get_running_loop().time()
+            if delay > 0:
+                # Wake up early if a sooner reminder is scheduled in the meantime
+                try:
+                    await asyncio.wait_for(self.reminder_added.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _due, channel_id, name, reminder = heapq.heappop(self.reminder_queue)
+            if channel_id not in self.channels or self.reminders.get((channel_id, name)) != reminder:
+                continue
+            self.reminders.pop((channel_id, name))
+
+            try:
+                await self.channels[channel_id].send(self.REMINDER_MESSAGES[name])
+            except Exception as e:
+                self.logger.error(f"Could not send reminder to {channel_id}: " + str(e))
 
 intents = discord.Intents(guilds=True, members=True, messages=True, message_content=True)
 bot = commands.Bot(command_prefix='!', help_command=None, intents=intents)
@@ -971,24 +1224,9 @@ async def on_ready():
     await bot.add_cog(Spelling(bot))
     await bot.add_cog(BumpReminder(bot))
 
-@bot.listen('on_message')
-async def message_listener(msg):
-    if msg.author == bot.user:
-        return
-    if not isinstance(msg.channel, discord.DMChannel):
-        return
-
-    await msg.channel.send(random.choice(["meow", "мяу", "miauw", "مياو"]))
-
-    if random.random() < 0.05:
-        logging.getLogger('discord').info(f"{msg.author.display_name} is getting a selfie")
-
-        try:
-            random_img = os.path.join("selfies", random.choice(os.listdir("selfies")))
-            async with msg.channel.typing():
-                await msg.channel.send(file=discord.File(random_img))
-        except OSError:
-            pass
+def append_removed_word(word):
+    with open("removed_words.txt", "a") as f:
+        f.write(word + '\n')
 
 @bot.command(hidden=True)
 @commands.check_any(commands.is_owner(), commands.has_permissions(administrator=True))
@@ -997,15 +1235,28 @@ async def remove(ctx, word=None):
         await ctx.reply("You need to tell me which word to remove")
         return
 
-    try:
-        common_words.remove(word)
-        common_words_by_length[len(word)].remove(word)
-        with open("removed_words.txt", "a") as f:
-            f.write(word + '\n')
-        logging.getLogger('discord').warning(f"{ctx.author.display_name} removed {word}")
-        await ctx.reply(f"Removing {word} from my list of target words")
-    except ValueError:
+    if word not in common_words_set:
         await ctx.reply(f"{word} does not seem to occur in my list. Try checking the spelling.")
+        return
+
+    # Only the set and the lists by length are used once the bot is running
+    common_words_set.discard(word)
+    if len(word) < len(common_words_by_length):
+        # The word list has some duplicates, every copy has to go
+        bucket = common_words_by_length[len(word)]
+        bucket[:] = [w for w in bucket if w != word]
+    await asyncio.to_thread(append_removed_word, word)
+    logging.getLogger('discord').warning(f"{ctx.author.display_name} removed {word}")
+    await ctx.reply(f"Removing {word} from my list of target words")
+
+async def main():
+    # With eager tasks, listeners that return without awaiting anything finish on the spot,
+    # instead of taking a trip through the event loop's scheduler (Python 3.12+)
+    if hasattr(asyncio, "eager_task_factory"):
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+
+    async with bot:
+        await bot.start(os.getenv("TOKEN"))
 
 if __name__ == "__main__":
     handler = logging.handlers.RotatingFileHandler("discord.log",
@@ -1019,6 +1270,17 @@ if __name__ == "__main__":
         )
     )
 
-    logging.getLogger('discord').addHandler(handler)
+    # The log file is written from a separate thread, so logging never blocks the event loop
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    logging.getLogger('discord').addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
 
-    bot.run(os.getenv("TOKEN"))
+    # bot.run would do this, but it doesn't let us pick the task factory
+    discord.utils.setup_logging(root=False)
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.stop()